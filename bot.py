@@ -1,10 +1,13 @@
 import os
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import ApplicationBuilder, MessageHandler, ContextTypes, filters
+from telegram.ext import ApplicationBuilder, MessageHandler, TypeHandler, ContextTypes, ApplicationHandlerStop, filters
 import requests
 import sqlite3
 import logging
+import asyncio
+import socket
+import time
 from datetime import datetime
 
 
@@ -19,9 +22,32 @@ logger = logging.getLogger(__name__)
 # Загрузка переменных окружения
 load_dotenv()
 
+from storage import DB_PATH, DB_TIMEOUT, create_storage, check_shared_database
+from export import export_orders, parse_date, EXPORT_FORMATS
+
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 YANDEX_DISK_TOKEN = os.getenv("YANDEX_DISK_TOKEN")
 COMPANY_GROUP_ID = int(os.getenv("COMPANY_GROUP_ID"))
+# ID администраторов через запятую, им доступна команда /export
+ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+# Адрес для webhook; если не задан, бот работает через polling (только одна реплика)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+
+# === Общее хранилище для реплик ===
+# STORAGE_URL: пусто или sqlite:///путь - файл SQLite, redis://host:port/db - Redis
+storage = create_storage(os.getenv("STORAGE_URL"))
+# Уникальное имя реплики, под которым она захватывает задачи
+REPLICA_ID = os.getenv("REPLICA_ID") or f"{socket.gethostname()}:{os.getpid()}"
+
+USER_LOCK_SECONDS = 120      # Аренда блокировки пользователя на время обработки обновления
+USER_LOCK_WAIT_SECONDS = 30  # Сколько ждать, пока другая реплика освободит пользователя
+REPORT_LEASE_SECONDS = 300   # Аренда задачи отправки отчёта
+REPORT_MAX_ATTEMPTS = 5      # После стольких неудачных попыток отчёт откладывается в failed_reports
+REPORT_DONE_SECONDS = 24 * 60 * 60  # Сколько помнить отправленный отчёт, чтобы не отправить его повторно
+REPORT_RECOVERY_SECONDS = 60        # Как часто искать отчёты, брошенные упавшей репликой
+UPDATE_DEDUP_SECONDS = 60 * 60      # Сколько помнить обработанные update_id
+FOLDER_CACHE_SECONDS = 10 * 60      # Сколько кэшировать найденные папки заказов
+EXPORT_MAX_FILE_SIZE = 50 * 1024 * 1024  # Bot API не принимает документы больше 50 МБ
 
 YANDEX_DISK_API_URL = "https://cloud-api.yandex.net/v1/disk/resources"
 
@@ -29,7 +55,7 @@ YANDEX_DISK_API_URL = "https://cloud-api.yandex.net/v1/disk/resources"
 
 # Функция для создания базы данных и таблиц
 def create_db():
-    connection = sqlite3.connect('data/bot_database.db')  # Название файла базы данных
+    connection = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)  # Название файла базы данных
     cursor = connection.cursor()
 
     # Создание таблицы пользователей
@@ -54,6 +80,12 @@ def create_db():
     );
     ''')
 
+    # Дата создания заказа (нужна для выгрузки по периоду)
+    cursor.execute('PRAGMA table_info(orders)')
+    if 'created_at' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute('ALTER TABLE orders ADD COLUMN created_at TEXT')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_orders_created_at ON orders (created_at)')
+
     # Закрытие соединения с базой данных
     connection.commit()
     connection.close()
@@ -61,8 +93,11 @@ def create_db():
 # Вызовем функцию для создания базы данных и таблиц при старте бота
 create_db()
 
+# Пользователи и заказы хранятся только в SQLite: убеждаемся, что все реплики видят один и тот же файл
+check_shared_database(storage, DB_PATH)
+
 def get_user_profile(user_id):
-    connection = sqlite3.connect('data/bot_database.db')
+    connection = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
     cursor = connection.cursor()
 
     cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
@@ -78,7 +113,7 @@ def update_user_profile(user_id, username, order_number):
 
     # Если профиль не найден, создаём новый
     if not profile:
-        connection = sqlite3.connect('data/bot_database.db')
+        connection = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
         cursor = connection.cursor()
 
         cursor.execute('''
@@ -96,7 +131,7 @@ def update_user_profile(user_id, username, order_number):
     if len(last_orders.split('\n')) > 5:
         last_orders = '\n'.join(last_orders.split('\n')[:5])  # Оставляем только 5 последних заказов
 
-    connection = sqlite3.connect('data/bot_database.db')
+    connection = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
     cursor = connection.cursor()
 
     cursor.execute('''
@@ -111,19 +146,19 @@ def update_user_profile(user_id, username, order_number):
     return get_user_profile(user_id)
 
 def add_order(user_id, order_number, status, comment):
-    connection = sqlite3.connect('data/bot_database.db')
+    connection = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
     cursor = connection.cursor()
 
     cursor.execute('''
-    INSERT INTO orders (user_id, order_number, status, comment)
-    VALUES (?, ?, ?, ?);
-    ''', (user_id, order_number, status, comment))
+    INSERT INTO orders (user_id, order_number, status, comment, created_at)
+    VALUES (?, ?, ?, ?, ?);
+    ''', (user_id, order_number, status, comment, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
 
     connection.commit()
     connection.close()
 
 def get_user_orders(user_id):
-    connection = sqlite3.connect('data/bot_database.db')
+    connection = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
     cursor = connection.cursor()
 
     cursor.execute('SELECT * FROM orders WHERE user_id = ?', (user_id,))
@@ -139,7 +174,7 @@ def add_user(user_id, username):
 
     if not profile:
         # Если пользователя нет, добавляем нового
-        connection = sqlite3.connect('data/bot_database.db')
+        connection = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
         cursor = connection.cursor()
 
         cursor.execute('''
@@ -155,7 +190,7 @@ def add_user(user_id, username):
 
 
 def add_order_number_column():
-    conn = sqlite3.connect('data/bot_database.db')
+    conn = sqlite3.connect(DB_PATH, timeout=DB_TIMEOUT)
     cursor = conn.cursor()
 
     try:
@@ -174,10 +209,15 @@ def add_order_number_column():
 # === Вспомогательные функции для работы с Яндекс.Диском ===
 def check_folder_exists(order_number):
     logger.info(f"Проверка существования папки для заказа: {order_number}")
+    if storage.get('folders', order_number):
+        logger.info(f"Папка {order_number} существует (из кэша).")
+        return True
+
     headers = {"Authorization": f"OAuth {YANDEX_DISK_TOKEN}"}
     response = requests.get(f"{YANDEX_DISK_API_URL}?path={order_number}", headers=headers)
     if response.status_code == 200:
         logger.info(f"Папка {order_number} существует.")
+        storage.set('folders', order_number, True, ttl=FOLDER_CACHE_SECONDS)
     else:
         logger.warning(f"Папка {order_number} не найдена.")
     return response.status_code == 200
@@ -209,6 +249,153 @@ def upload_to_yandex_disk(order_number, file_path, file_name):
 from telegram import Update
 from telegram.ext import ContextTypes
 
+# === Общее состояние пользователей для нескольких реплик ===
+# Перед обработчиками (группа -1) состояние пользователя загружается из хранилища
+# в context.user_data, после них (группа 1) сохраняется обратно. На это время
+# реплика держит аренду пользователя, а внутри процесса - asyncio.Lock, чтобы
+# обновления одного пользователя шли по очереди. Обновления разных пользователей
+# обрабатываются параллельно (concurrent_updates), поэтому ожидание аренды одного
+# пользователя не задерживает остальных.
+#
+# Обновление атомарно помечается как взятое в работу (storage.add) на время
+# USER_LOCK_SECONDS: после успеха отметка продлевается, после ошибки удаляется,
+# а если реплика упала, она истечёт и повторная доставка будет обработана.
+
+# Блокировки пользователей внутри процесса, по user_id
+_user_locks = {}
+# Фоновые задачи продления аренды пользователя, по update_id
+_user_lease_tasks = {}
+# update_id, на которых обработчик завершился ошибкой
+_failed_updates = set()
+
+
+async def _keep_user_lease(lock_id, update_id):
+    # Продлеваем аренду пользователя и отметку обновления, пока обработчик не закончил работу
+    while True:
+        await asyncio.sleep(USER_LOCK_SECONDS / 3)
+        if not await asyncio.to_thread(storage.renew_job, lock_id, REPLICA_ID, USER_LOCK_SECONDS):
+            logger.error(f"Аренда {lock_id} потеряна во время обработки.")
+            return
+        await asyncio.to_thread(storage.set, 'updates', update_id, REPLICA_ID, ttl=USER_LOCK_SECONDS)
+
+
+async def _claim_user(lock_id):
+    # Ждём, пока другая реплика отпустит пользователя; ждёт только это обновление
+    deadline = time.monotonic() + USER_LOCK_WAIT_SECONDS
+    while not await asyncio.to_thread(storage.claim_job, lock_id, REPLICA_ID, USER_LOCK_SECONDS):
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.2)
+    return True
+
+
+async def _skip_update(update: Update, text):
+    if update.effective_message:
+        try:
+            await update.effective_message.reply_text(text)
+        except Exception as e:
+            logger.error(f"Ошибка при отправке сообщения: {e}")
+    raise ApplicationHandlerStop
+
+
+async def _forget_update(update: Update, lock_id=None):
+    # Снимаем отметку об обновлении (и аренду), чтобы его можно было обработать повторно
+    try:
+        if lock_id:
+            await asyncio.to_thread(storage.release_job, lock_id, REPLICA_ID)
+        await asyncio.to_thread(storage.delete, 'updates', update.update_id)
+    except Exception as e:
+        logger.error(f"Не удалось снять отметку обновления {update.update_id}: {e}")
+
+
+async def load_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    try:
+        # Одно и то же обновление могло прийти в несколько реплик
+        claimed = await asyncio.to_thread(
+            storage.add, 'updates', update.update_id, REPLICA_ID, ttl=USER_LOCK_SECONDS
+        )
+    except Exception as e:
+        logger.error(f"Хранилище недоступно, обновление {update.update_id} пропущено: {e}")
+        context.user_data.clear()
+        await _skip_update(update, "Сервис временно недоступен. Повторите, пожалуйста, позже.")
+    if not claimed:
+        logger.info(f"Обновление {update.update_id} уже обработано или обрабатывается.")
+        raise ApplicationHandlerStop
+
+    user = update.effective_user
+    if not user:
+        return
+
+    user_lock = _user_locks.setdefault(user.id, asyncio.Lock())
+    await user_lock.acquire()
+
+    lock_id = f"user:{user.id}"
+    try:
+        has_lease = await _claim_user(lock_id)
+        state = await asyncio.to_thread(storage.get, 'state', user.id) if has_lease else None
+    except Exception as e:
+        # Без аренды и свежего состояния обработчики работали бы со старыми данными
+        logger.error(f"Хранилище недоступно, обновление {update.update_id} пропущено: {e}")
+        context.user_data.clear()
+        user_lock.release()
+        await _forget_update(update, lock_id)
+        await _skip_update(update, "Сервис временно недоступен. Повторите, пожалуйста, позже.")
+
+    if not has_lease:
+        logger.warning(f"Не удалось дождаться освобождения пользователя {user.id}, обновление {update.update_id} пропущено.")
+        user_lock.release()
+        await _forget_update(update)
+        await _skip_update(update, "Предыдущее действие ещё обрабатывается. Повторите, пожалуйста, через минуту.")
+
+    _user_lease_tasks[update.update_id] = asyncio.create_task(_keep_user_lease(lock_id, update.update_id))
+
+    context.user_data.clear()
+    context.user_data.update(state or {})
+
+
+async def save_user_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    failed = update.update_id in _failed_updates
+    _failed_updates.discard(update.update_id)
+
+    user = update.effective_user
+    try:
+        if user:
+            task = _user_lease_tasks.pop(update.update_id, None)
+            if task:
+                task.cancel()
+
+            lock_id = f"user:{user.id}"
+            if not await asyncio.to_thread(storage.renew_job, lock_id, REPLICA_ID, USER_LOCK_SECONDS):
+                # Пользователем уже владеет другая реплика, её состояние не перезаписываем
+                logger.error(f"Аренда {lock_id} потеряна, состояние пользователя не сохранено.")
+                return
+
+            # При ошибке состояние не сохраняем, чтобы повтор начался с того же шага
+            if not failed:
+                if context.user_data:
+                    await asyncio.to_thread(storage.set, 'state', user.id, dict(context.user_data))
+                else:
+                    await asyncio.to_thread(storage.delete, 'state', user.id)
+
+        if failed:
+            # Разрешаем повторную доставку этого обновления
+            await asyncio.to_thread(storage.delete, 'updates', update.update_id)
+        else:
+            await asyncio.to_thread(storage.set, 'updates', update.update_id, REPLICA_ID, ttl=UPDATE_DEDUP_SECONDS)
+
+        if user:
+            await asyncio.to_thread(storage.release_job, f"user:{user.id}", REPLICA_ID)
+    finally:
+        if user and user.id in _user_locks and _user_locks[user.id].locked():
+            _user_locks[user.id].release()
+
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    logger.error("Ошибка при обработке обновления", exc_info=context.error)
+    if isinstance(update, Update):
+        _failed_updates.add(update.update_id)
+
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()  # Подтверждаем получение callback'а
@@ -319,18 +506,13 @@ async def handle_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(profile_info, parse_mode='Markdown')
 
 
-async def update_profile(user_id, order_number, context):
-    try:
-        # Используем данные из текущего контекста
-        username = context.user_data.get('username') or "Неизвестный пользователь"
-
-        # Обновляем профиль пользователя в базе данных
-        update_user_profile(user_id, username, order_number)
+async def update_profile(user_id, username, order_number):
+    # Обновляем профиль пользователя в базе данных. Ошибку не глотаем:
+    # отчёт без обновлённого профиля должен быть обработан повторно
+    await asyncio.to_thread(update_user_profile, user_id, username, order_number)
 
-        # Выводим лог, что профиль обновлен
-        logger.info(f"Профиль пользователя {user_id} обновлен после заказа №{order_number}")
-    except Exception as e:
-        logger.error(f"Ошибка при обновлении профиля: {e}")
+    # Выводим лог, что профиль обновлен
+    logger.info(f"Профиль пользователя {user_id} обновлен после заказа №{order_number}")
 
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -431,7 +613,7 @@ async def handle_order_number(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     order_number = update.message.text
-    if not check_folder_exists(order_number):
+    if not await asyncio.to_thread(check_folder_exists, order_number):
         await update.message.reply_text("Папка для указанного заказа не найдена. Введите корректный номер заказа.")
         return
 
@@ -453,7 +635,8 @@ async def handle_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     location = update.message.location
-    context.user_data['location'] = location  # Сохраняем геопозицию
+    # Сохраняем геопозицию (только координаты, чтобы состояние сериализовалось в хранилище)
+    context.user_data['location'] = {'latitude': location.latitude, 'longitude': location.longitude}
     logger.info(f"Геопозиция получена: {location.latitude}, {location.longitude}")
 
     
@@ -525,66 +708,86 @@ def get_address_from_coordinates(latitude, longitude):
         return "Ошибка при получении адреса"
 
 
-# Обработчик комментария
-async def handle_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    logging.info(f"context.user_data перед обработкой: {context.user_data}")
-
-    if context.user_data.get('state') != 'COMMENT':
+# Файл мог быть скачан другой репликой, тогда скачиваем его заново по file_id
+async def ensure_local_media(media, bot):
+    local_path = media['local_path']
+    if os.path.exists(local_path):
         return
-
-    # Сохраняем комментарий пользователя
-    context.user_data['comment'] = update.message.text
-    context.user_data['state'] = 'FINISHED'
+    logger.info(f"Файл {local_path} отсутствует локально, скачиваем заново.")
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    file = await bot.get_file(media['file_id'])
+    await file.download_to_drive(local_path)
+
+
+# Отправка отчёта: загрузка файлов на Яндекс.Диск, сообщение в группу и запись в базу.
+# Вызывается только репликой, захватившей аренду job_id. Возвращает False, если аренда потеряна.
+# Выполненные шаги записываются в отчёт в хранилище, поэтому при повторной обработке
+# (после падения реплики или ошибки) они пропускаются. Гарантия - "хотя бы один раз":
+# шаг, выполненный прямо перед падением, но не успевший записаться, повторится.
+async def process_report(bot, job_id, report):
+    async def keep_lease():
+        if await asyncio.to_thread(storage.renew_job, job_id, REPLICA_ID, REPORT_LEASE_SECONDS):
+            return True
+        logger.warning(f"Аренда отчёта {job_id} потеряна, обработка прекращена.")
+        return False
+
+    async def checkpoint():
+        # Записываем прогресс, только пока отчёт всё ещё наш
+        if not await keep_lease():
+            return False
+        await asyncio.to_thread(storage.set, 'reports', job_id, report)
+        return True
+
+    report.setdefault('uploaded', [])         # Индексы файлов, загруженных на Яндекс.Диск
+    report.setdefault('sent', [])             # Индексы файлов, отправленных в группу
+    report.setdefault('order_added', False)
+    report.setdefault('profile_updated', False)
 
     # Логируем начало обработки
-    logger.info("Обработка завершённого заказа начата.")
-    order_number = context.user_data['order_number']
-    media_files = context.user_data.get('media', [])
+    logger.info(f"Обработка отчёта {job_id} начата.")
+    order_number = report['order_number']
+    media_files = report['media']
 
     # Загружаем файлы на Яндекс.Диск
     for idx, media in enumerate(media_files):
+        if idx in report['uploaded']:
+            continue
+        if not await keep_lease():
+            return False
         try:
+            await ensure_local_media(media, bot)
             local_path = media['local_path']
-            upload_successful = upload_to_yandex_disk(order_number, local_path, os.path.basename(local_path))
+            upload_successful = await asyncio.to_thread(
+                upload_to_yandex_disk, order_number, local_path, os.path.basename(local_path)
+            )
             if not upload_successful:
                 logger.error(f"Ошибка при загрузке файла {idx + 1}: {local_path}")
+                continue
         except Exception as e:
             logger.error(f"Ошибка при обработке файла {idx + 1}: {e}")
+            continue
+        report['uploaded'].append(idx)
+        if not await checkpoint():
+            return False
 
     logger.info("Файлы успешно обработаны. Отправка отчёта в группу.")
 
-    # Обновление данных профиля в базе данных
-    user_id = update.effective_user.id
-    await update_profile(user_id, order_number, context)
-
-    # Сохранение заказа в базу данных
-    add_order(
-        user_id=user_id,
-        order_number=order_number,
-        status=context.user_data.get('success') == "yes",  # Преобразуем успех в boolean
-        comment=context.user_data['comment'],
-    )
-
-    # Формирование отчёта
-    user = update.effective_user
-    user_name = user.name if user.name else "Неизвестный пользователь"
-
-    success_message = "Да" if context.user_data.get('success') == "yes" else "Нет"
+    success_message = "Да" if report['success'] == "yes" else "Нет"
     report_caption = (
-        f"Новый отчёт от пользователя: {user_name}\n"
+        f"Новый отчёт от пользователя: {report['user_name']}\n"
         f"📦 Номер заказа: {order_number}\n"
         f"✅ Всё прошло хорошо: {success_message}\n"
-        f"📝 Комментарий: {context.user_data['comment']}\n"
+        f"📝 Комментарий: {report['comment']}\n"
     )
 
     # Проверка наличия геопозиции
-    location = context.user_data.get('location')
+    location = report['location']
     if location:
-        latitude = location.latitude
-        longitude = location.longitude
+        latitude = location['latitude']
+        longitude = location['longitude']
 
         # Получаем адрес по координатам
-        address = get_address_from_coordinates(latitude, longitude)
+        address = await asyncio.to_thread(get_address_from_coordinates, latitude, longitude)
 
         # Формируем ссылку на Яндекс.Карты с точной меткой
         yandex_maps_url = f"https://yandex.ru/maps/?ll={longitude},{latitude}&z=15&pt={longitude},{latitude},pm2rdm"  # Ссылка на Яндекс.Карты с точкой
@@ -592,47 +795,186 @@ async def handle_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Добавляем адрес и кнопку в отчет
         report_caption += f"📍 Геопозиция: {address}  [Смотреть на карте]({yandex_maps_url})\n"
 
-
+        # Подпись уходит только с первым медиа; если оно уже отправлено, подпись не нужна
+        if report['sent']:
+            report_caption = None
 
         # Отправка медиа в отчёт
-        for media in media_files:
-            try:
-                media_path = media['local_path']
-                media_type = media['type']
+        for idx, media in enumerate(media_files):
+            if idx in report['sent']:
+                continue
+
+            # Перед каждой отправкой проверяем, что отчёт всё ещё наш
+            if not await keep_lease():
+                return False
 
-                # Проверка существования файла
-                if not os.path.exists(media_path):
-                    logger.error(f"Файл {media_path} не найден. Пропуск отправки.")
-                    continue
+            media_path = media['local_path']
+            media_type = media['type']
+            try:
+                await ensure_local_media(media, bot)
 
                 # Отправка фото или видео
                 if media_type == "photo":
                     with open(media_path, 'rb') as photo:
-                        await context.bot.send_photo(chat_id=COMPANY_GROUP_ID, photo=photo, caption=report_caption,parse_mode='Markdown')
+                        await bot.send_photo(chat_id=COMPANY_GROUP_ID, photo=photo, caption=report_caption, parse_mode='Markdown')
                 elif media_type == "video":
                     with open(media_path, 'rb') as video:
-                        await context.bot.send_video(chat_id=COMPANY_GROUP_ID, video=video, caption=report_caption,parse_mode='Markdown')
+                        await bot.send_video(chat_id=COMPANY_GROUP_ID, video=video, caption=report_caption, parse_mode='Markdown')
 
-                logger.info(f"Содержимое media_files перед отправкой: {media_files}")
                 logger.info(f"Текст отчёта: {report_caption}")
+            except Exception as e:
+                logger.error(f"Ошибка при отправке медиа {media_path}: {e}")
+                continue
+
+            report['sent'].append(idx)
+            # После отправки медиа отчёт можно отправить только с первой частью текста
+            report_caption = None
+            if not await checkpoint():
+                return False
 
-                # Удаление файла после отправки
+            # Удаление файла после отправки
+            try:
                 os.remove(media_path)
                 logger.info(f"Файл {media_path} успешно отправлен и удалён.")
-                # После отправки медиа отчёт можно отправить только с первой частью текста
-                report_caption = None
-            except Exception as e:
-                logger.error(f"Ошибка при отправке медиа {media_path}: {e}")
+            except OSError as e:
+                logger.error(f"Не удалось удалить файл {media_path}: {e}")
 
-        # Очистка данных пользователя
-    context.user_data.clear()
-    logger.info("Отчёт отправлен. Данные пользователя очищены.")
+    # Сохранение заказа в базу данных
+    if not report['order_added']:
+        await asyncio.to_thread(
+            add_order,
+            user_id=report['user_id'],
+            order_number=order_number,
+            status=report['success'] == "yes",  # Преобразуем успех в boolean
+            comment=report['comment'],
+        )
+        report['order_added'] = True
+        if not await checkpoint():
+            return False
+
+    # Обновление данных профиля в базе данных
+    if not report['profile_updated']:
+        await update_profile(report['user_id'], report['username'], order_number)
+        report['profile_updated'] = True
+        if not await checkpoint():
+            return False
+
+    # Оставляем аренду за собой, чтобы повторная доставка не отправила отчёт ещё раз
+    if not await asyncio.to_thread(storage.renew_job, job_id, REPLICA_ID, REPORT_DONE_SECONDS):
+        logger.warning(f"Аренда отчёта {job_id} истекла к моменту завершения.")
+    await asyncio.to_thread(storage.delete, 'reports', job_id)
+    logger.info(f"Отчёт {job_id} отправлен.")
+    return True
+
+
+# Обработка отчёта в фоне с учётом числа попыток и уведомлением пользователя.
+# Вызывающий должен уже держать аренду job_id.
+async def run_report(bot, job_id, report):
+    report['attempts'] = report.get('attempts', 0) + 1
+    try:
+        if report['attempts'] > REPORT_MAX_ATTEMPTS:
+            # Отчёт, который раз за разом падает, откладываем, чтобы не слать его в группу бесконечно
+            logger.error(f"Отчёт {job_id} не удалось отправить за {REPORT_MAX_ATTEMPTS} попыток, он перенесён в failed_reports.")
+            await asyncio.to_thread(storage.set, 'failed_reports', job_id, report)
+            await asyncio.to_thread(storage.delete, 'reports', job_id)
+            await asyncio.to_thread(storage.renew_job, job_id, REPLICA_ID, REPORT_DONE_SECONDS)
+            await bot.send_message(
+                chat_id=report['chat_id'],
+                text=f"Не удалось отправить отчёт по заказу №{report['order_number']}. Обратитесь в техподдержку."
+            )
+            return
+
+        await asyncio.to_thread(storage.set, 'reports', job_id, report)
+        sent = await process_report(bot, job_id, report)
+    except Exception as e:
+        # Отпускаем аренду, чтобы отчёт смогла дослать любая реплика (см. recover_reports)
+        logger.error(f"Ошибка при отправке отчёта {job_id} (попытка {report['attempts']}): {e}")
+        try:
+            await asyncio.to_thread(storage.release_job, job_id, REPLICA_ID)
+        except Exception as release_error:
+            logger.error(f"Не удалось освободить отчёт {job_id}: {release_error}")
+        return
+
+    if not sent:
+        return
 
     # Предложение начать новый заказ
-    await update.message.reply_text(
-        "Отчёт успешно отправлен! Хотите загрузить новый заказ?",
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Начать новый заказ", callback_data="restart")]]),
-    )
+    try:
+        await bot.send_message(
+            chat_id=report['chat_id'],
+            text=f"Отчёт по заказу №{report['order_number']} успешно отправлен! Хотите загрузить новый заказ?",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Начать новый заказ", callback_data="restart")]]),
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при уведомлении пользователя об отчёте {job_id}: {e}")
+
+
+# Обработчик комментария
+async def handle_comment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    logging.info(f"context.user_data перед обработкой: {context.user_data}")
+
+    if context.user_data.get('state') != 'COMMENT':
+        return
+
+    # Сохраняем комментарий пользователя
+    context.user_data['comment'] = update.message.text
+    context.user_data['state'] = 'FINISHED'
+
+    # Захватываем задачу отправки отчёта, чтобы его не обработали две реплики
+    user = update.effective_user
+    job_id = f"report:{user.id}:{update.message.message_id}"
+    if not await asyncio.to_thread(storage.claim_job, job_id, REPLICA_ID, REPORT_LEASE_SECONDS):
+        logger.info(f"Отчёт {job_id} уже обрабатывается.")
+        context.user_data.clear()
+        await update.message.reply_text("Этот отчёт уже принят в обработку.")
+        return
+
+    # Сохраняем отчёт в хранилище: если реплика упадёт, его дошлёт другая (см. recover_reports)
+    report = {
+        'user_id': user.id,
+        'user_name': user.name if user.name else "Неизвестный пользователь",
+        'username': user.full_name,
+        'chat_id': update.effective_chat.id,
+        'order_number': context.user_data['order_number'],
+        'success': context.user_data.get('success'),
+        'comment': context.user_data['comment'],
+        'location': context.user_data.get('location'),
+        'media': context.user_data.get('media', []),
+    }
+    await asyncio.to_thread(storage.set, 'reports', job_id, report)
+
+    # Отчёт отправляется в фоне: пользователь освобождается сразу, а долгая
+    # загрузка файлов идёт под арендой отчёта, а не пользователя
+    context.user_data.clear()
+    logger.info(f"Отчёт {job_id} принят, данные пользователя очищены.")
+    context.application.create_task(run_report(context.bot, job_id, report), update=update)
+
+    await update.message.reply_text("Отчёт принят и отправляется. Мы сообщим, когда всё будет готово.")
+
+
+# Досылка отчётов, аренда которых истекла (реплика упала, потеряла аренду или получила ошибку)
+async def recover_reports(bot):
+    for job_id in await asyncio.to_thread(storage.keys, 'reports'):
+        if not await asyncio.to_thread(storage.claim_job, job_id, REPLICA_ID, REPORT_LEASE_SECONDS):
+            continue
+
+        report = await asyncio.to_thread(storage.get, 'reports', job_id)
+        if not report:
+            # Отчёт успели отправить, пока мы его захватывали
+            await asyncio.to_thread(storage.release_job, job_id, REPLICA_ID)
+            continue
+
+        logger.info(f"Повторная отправка отчёта {job_id}.")
+        await run_report(bot, job_id, report)
+
+
+async def recover_reports_loop(bot):
+    while True:
+        await asyncio.sleep(REPORT_RECOVERY_SECONDS)
+        try:
+            await recover_reports(bot)
+        except Exception as e:
+            logger.error(f"Ошибка при поиске брошенных отчётов: {e}")
 
 
 async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -661,11 +1003,90 @@ async def restart(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['order_number'] = None  # Для хранения номера заказа
 
 
+# Выгрузка заказов для администраторов: /export [csv|jsonl] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [user_id]
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in ADMIN_IDS:
+        logger.warning(f"Пользователь {user_id} попытался выполнить /export без прав администратора.")
+        await update.message.reply_text("Команда доступна только администраторам.")
+        return
+
+    args = context.args or []
+    try:
+        export_format = args[0] if len(args) > 0 else 'csv'
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(export_format)
+        date_from = parse_date(args[1]) if len(args) > 1 else None
+        date_to = parse_date(args[2]) if len(args) > 2 else None
+        filter_user_id = int(args[3]) if len(args) > 3 else None
+    except ValueError:
+        await update.message.reply_text(
+            "Использование: /export [csv|jsonl] [с ГГГГ-ММ-ДД] [по ГГГГ-ММ-ДД] [user_id]\n"
+            "Вместо даты можно указать '-', чтобы не ограничивать период."
+        )
+        return
+
+    temp_dir = "temp"
+    os.makedirs(temp_dir, exist_ok=True)
+    file_name = f"orders_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}.gz"
+    file_path = os.path.join(temp_dir, f"{uuid4().hex}_{file_name}")
+
+    try:
+        # Выгрузка идёт в отдельном потоке, чтобы не блокировать бота
+        count = await asyncio.to_thread(
+            export_orders, file_path, export_format,
+            date_from=date_from, date_to=date_to, user_id=filter_user_id,
+        )
+        file_size = os.path.getsize(file_path)
+        if file_size > EXPORT_MAX_FILE_SIZE:
+            logger.warning(f"Выгрузка {file_name} ({file_size} байт) больше лимита Telegram.")
+            await update.message.reply_text(
+                f"Файл выгрузки ({count} заказов, {file_size // (1024 * 1024)} МБ) больше 50 МБ, "
+                "Telegram не позволяет его отправить. Сузьте период или выберите одного пользователя, "
+                "либо выполните выгрузку на сервере: python export.py"
+            )
+            return
+        with open(file_path, 'rb') as document:
+            await update.message.reply_document(
+                document=document, filename=file_name, caption=f"Выгружено заказов: {count}"
+            )
+    except Exception as e:
+        logger.error(f"Ошибка при выгрузке заказов: {e}")
+        await update.message.reply_text("Не удалось выгрузить заказы.")
+    finally:
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+# Фоновая досылка брошенных отчётов живёт столько же, сколько приложение
+async def post_init(application):
+    application.bot_data['recover_reports_task'] = asyncio.create_task(recover_reports_loop(application.bot))
+
+
+async def post_stop(application):
+    task = application.bot_data.pop('recover_reports_task', None)
+    if task:
+        task.cancel()
+
+
 # Основной код
 def main():
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Обновления разных пользователей обрабатываются параллельно, одного - по очереди (см. load_user_state)
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_stop(post_stop)
+        .build()
+    )
+
+    # Загрузка и сохранение состояния пользователя вокруг всех остальных обработчиков
+    application.add_handler(TypeHandler(Update, load_user_state), group=-1)
+    application.add_handler(TypeHandler(Update, save_user_state), group=1)
 
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("export", export_command))
     application.add_handler(MessageHandler(filters.PHOTO | filters.VIDEO, handle_media))
     application.add_handler(CallbackQueryHandler(finish_media, pattern="^finish_media$"))
     application.add_handler(MessageHandler(filters.TEXT & filters.Regex(r'^\d+$'), handle_order_number))
@@ -679,7 +1100,20 @@ def main():
     # Добавляем обработчик для геопозиции
     application.add_handler(MessageHandler(filters.LOCATION, handle_location))  # Обрабатываем геопозицию
 
-    application.run_polling()
+    # Ошибки обработчиков: логируем и не отмечаем обновление обработанным
+    application.add_error_handler(error_handler)
+
+    if WEBHOOK_URL:
+        # Через webhook можно запускать несколько реплик за балансировщиком
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=int(os.getenv("PORT", 80)),
+            url_path="webhook",
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/webhook",
+            secret_token=os.getenv("WEBHOOK_SECRET"),
+        )
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
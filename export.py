@@ -0,0 +1,134 @@
+import argparse
+import csv
+import gzip
+import json
+import logging
+import sqlite3
+from datetime import datetime
+
+from storage import DB_PATH
+
+logger = logging.getLogger(__name__)
+
+# Размер пачки строк, которые читаются из базы за один раз
+BATCH_SIZE = 500
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+# Колонки выгрузки: заказ + профиль пользователя
+EXPORT_COLUMNS = (
+    'order_id',
+    'user_id',
+    'username',
+    'orders_count',
+    'order_number',
+    'status',
+    'comment',
+    'created_at',
+)
+
+
+def parse_date(value):
+    # Дата в формате ГГГГ-ММ-ДД, '-' или пустая строка означают "без фильтра"
+    if not value or value == '-':
+        return None
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+
+def iter_orders(db_path=DB_PATH, date_from=None, date_to=None, user_id=None, batch_size=BATCH_SIZE):
+    """Построчно отдаёт заказы вместе с профилем пользователя.
+
+    Строки читаются через курсор пачками по batch_size, поэтому в памяти
+    никогда не лежит больше одной пачки, независимо от размера таблицы.
+    """
+    query = '''
+    SELECT o.order_id, o.user_id, u.username, u.orders_count,
+           o.order_number, o.status, o.comment, o.created_at
+    FROM orders o
+    LEFT JOIN users u ON u.user_id = o.user_id
+    '''
+    conditions = []
+    params = []
+
+    if date_from:
+        conditions.append('o.created_at >= ?')
+        params.append(date_from.strftime('%Y-%m-%d'))
+    if date_to:
+        # Включаем весь день date_to целиком
+        conditions.append("o.created_at < date(?, '+1 day')")
+        params.append(date_to.strftime('%Y-%m-%d'))
+    if user_id is not None:
+        conditions.append('o.user_id = ?')
+        params.append(user_id)
+
+    if conditions:
+        query += 'WHERE ' + ' AND '.join(conditions) + '\n'
+    query += 'ORDER BY o.order_id'
+
+    connection = sqlite3.connect(db_path)
+    try:
+        cursor = connection.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        connection.close()
+
+
+def export_orders(output_path, export_format='csv', db_path=DB_PATH,
+                  date_from=None, date_to=None, user_id=None, batch_size=BATCH_SIZE):
+    """Пишет заказы в gzip-файл формата CSV или JSONL и возвращает число строк."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Неизвестный формат выгрузки: {export_format}")
+
+    count = 0
+    with gzip.open(output_path, 'wt', encoding='utf-8', newline='') as f:
+        rows = iter_orders(db_path, date_from, date_to, user_id, batch_size)
+        if export_format == 'csv':
+            writer = csv.writer(f)
+            writer.writerow(EXPORT_COLUMNS)
+            for row in rows:
+                writer.writerow(row)
+                count += 1
+        else:
+            for row in rows:
+                f.write(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n')
+                count += 1
+
+    logger.info(f"Выгружено заказов: {count} в файл {output_path}")
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка заказов и профилей пользователей")
+    parser.add_argument('output', help="Путь к выходному файлу (.csv.gz или .jsonl.gz)")
+    parser.add_argument('--format', dest='export_format', choices=EXPORT_FORMATS, default='csv')
+    parser.add_argument('--db', default=DB_PATH, help="Путь к файлу базы данных")
+    parser.add_argument('--from', dest='date_from', type=parse_date, help="Начальная дата, ГГГГ-ММ-ДД")
+    parser.add_argument('--to', dest='date_to', type=parse_date, help="Конечная дата, ГГГГ-ММ-ДД")
+    parser.add_argument('--user', dest='user_id', type=int, help="ID пользователя")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+
+    export_orders(
+        args.output,
+        export_format=args.export_format,
+        db_path=args.db,
+        date_from=args.date_from,
+        date_to=args.date_to,
+        user_id=args.user_id,
+        batch_size=args.batch_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
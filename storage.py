@@ -0,0 +1,343 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+
+# Путь к файлу базы данных SQLite, общий для бота, выгрузки и хранилища состояния
+DB_PATH = os.getenv("DB_PATH", 'data/bot_database.db')
+
+# Сколько ждать блокировку файла SQLite, если в него одновременно пишут несколько реплик
+DB_TIMEOUT = 30
+
+# Как часто SQLite-хранилище удаляет просроченные записи и аренды
+PURGE_INTERVAL_SECONDS = 60
+
+
+class Storage(ABC):
+    """Общее хранилище для нескольких реплик бота.
+
+    Хранит состояние диалогов, кэш и отметки для дедупликации (значения
+    сериализуются в JSON), а также аренды (lease) задач: задачей владеет
+    та реплика, которая её захватила, пока не истечёт срок аренды.
+    """
+
+    @abstractmethod
+    def get(self, namespace, key):
+        pass
+
+    @abstractmethod
+    def set(self, namespace, key, value, ttl=None):
+        pass
+
+    @abstractmethod
+    def delete(self, namespace, key):
+        pass
+
+    @abstractmethod
+    def add(self, namespace, key, value, ttl=None):
+        """Записывает значение, только если ключа ещё нет. Возвращает True при успехе."""
+
+    @abstractmethod
+    def keys(self, namespace):
+        """Возвращает список действующих ключей пространства имён."""
+
+    @abstractmethod
+    def claim_job(self, job_id, owner, lease_seconds):
+        """Захватывает задачу, если она свободна или аренда истекла. Возвращает True при успехе."""
+
+    @abstractmethod
+    def renew_job(self, job_id, owner, lease_seconds):
+        """Продлевает действующую аренду, если задачей всё ещё владеет owner. Возвращает True при успехе."""
+
+    @abstractmethod
+    def release_job(self, job_id, owner):
+        """Освобождает задачу, если ею владеет owner."""
+
+    def close(self):
+        pass
+
+
+class SqliteStorage(Storage):
+    """Хранилище в файле SQLite. Подходит для одной реплики или реплик с общим диском."""
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._next_purge = 0
+
+        connection = self._connect()
+        cursor = connection.cursor()
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS kv_store (
+            namespace TEXT,                       -- Пространство имён (state, cache, ...)
+            key TEXT,                             -- Ключ
+            value TEXT,                           -- Значение в JSON
+            expires_at REAL,                      -- Время истечения (unix), NULL - бессрочно
+            PRIMARY KEY (namespace, key)
+        );
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_kv_store_expires_at ON kv_store (expires_at)')
+
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS job_leases (
+            job_id TEXT PRIMARY KEY,              -- Идентификатор задачи
+            owner TEXT,                           -- Реплика, владеющая задачей
+            lease_until REAL                      -- До какого времени действует аренда (unix)
+        );
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_job_leases_lease_until ON job_leases (lease_until)')
+
+        connection.commit()
+        connection.close()
+
+    def _connect(self):
+        # timeout нужен, чтобы реплики ждали блокировку файла, а не падали сразу
+        return sqlite3.connect(self.db_path, timeout=DB_TIMEOUT)
+
+    @staticmethod
+    def _expires_at(ttl):
+        return time.time() + ttl if ttl else None
+
+    def _purge_expired(self, cursor):
+        # Просроченные записи не нужны никому, удаляем их не чаще раза в PURGE_INTERVAL_SECONDS
+        now = time.time()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + PURGE_INTERVAL_SECONDS
+
+        cursor.execute('DELETE FROM kv_store WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,))
+        cursor.execute('DELETE FROM job_leases WHERE lease_until <= ?', (now,))
+
+    def get(self, namespace, key):
+        connection = self._connect()
+        cursor = connection.cursor()
+
+        cursor.execute('''
+        SELECT value FROM kv_store
+        WHERE namespace = ? AND key = ? AND (expires_at IS NULL OR expires_at > ?);
+        ''', (namespace, str(key), time.time()))
+        row = cursor.fetchone()
+
+        connection.close()
+
+        return json.loads(row[0]) if row else None
+
+    def set(self, namespace, key, value, ttl=None):
+        connection = self._connect()
+        cursor = connection.cursor()
+        self._purge_expired(cursor)
+
+        cursor.execute('''
+        INSERT OR REPLACE INTO kv_store (namespace, key, value, expires_at)
+        VALUES (?, ?, ?, ?);
+        ''', (namespace, str(key), json.dumps(value, ensure_ascii=False), self._expires_at(ttl)))
+
+        connection.commit()
+        connection.close()
+
+    def delete(self, namespace, key):
+        connection = self._connect()
+        cursor = connection.cursor()
+
+        cursor.execute('DELETE FROM kv_store WHERE namespace = ? AND key = ?', (namespace, str(key)))
+
+        connection.commit()
+        connection.close()
+
+    def add(self, namespace, key, value, ttl=None):
+        connection = self._connect()
+        cursor = connection.cursor()
+        self._purge_expired(cursor)
+
+        # Перезаписываем только просроченную запись
+        cursor.execute('''
+        INSERT INTO kv_store (namespace, key, value, expires_at)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (namespace, key) DO UPDATE
+        SET value = excluded.value, expires_at = excluded.expires_at
+        WHERE kv_store.expires_at IS NOT NULL AND kv_store.expires_at <= ?;
+        ''', (namespace, str(key), json.dumps(value, ensure_ascii=False), self._expires_at(ttl), time.time()))
+        added = cursor.rowcount > 0
+
+        connection.commit()
+        connection.close()
+
+        return added
+
+    def keys(self, namespace):
+        connection = self._connect()
+        cursor = connection.cursor()
+
+        cursor.execute('''
+        SELECT key FROM kv_store
+        WHERE namespace = ? AND (expires_at IS NULL OR expires_at > ?);
+        ''', (namespace, time.time()))
+        keys = [row[0] for row in cursor.fetchall()]
+
+        connection.close()
+
+        return keys
+
+    def claim_job(self, job_id, owner, lease_seconds):
+        now = time.time()
+        connection = self._connect()
+        cursor = connection.cursor()
+        self._purge_expired(cursor)
+
+        cursor.execute('''
+        INSERT INTO job_leases (job_id, owner, lease_until)
+        VALUES (?, ?, ?)
+        ON CONFLICT (job_id) DO UPDATE
+        SET owner = excluded.owner, lease_until = excluded.lease_until
+        WHERE job_leases.lease_until <= ?;
+        ''', (job_id, owner, now + lease_seconds, now))
+        claimed = cursor.rowcount > 0
+
+        connection.commit()
+        connection.close()
+
+        return claimed
+
+    def renew_job(self, job_id, owner, lease_seconds):
+        now = time.time()
+        connection = self._connect()
+        cursor = connection.cursor()
+
+        # Истёкшую аренду продлить нельзя: задачу уже может захватить другая реплика
+        cursor.execute('''
+        UPDATE job_leases SET lease_until = ?
+        WHERE job_id = ? AND owner = ? AND lease_until > ?;
+        ''', (now + lease_seconds, job_id, owner, now))
+        renewed = cursor.rowcount > 0
+
+        connection.commit()
+        connection.close()
+
+        return renewed
+
+    def release_job(self, job_id, owner):
+        connection = self._connect()
+        cursor = connection.cursor()
+
+        cursor.execute('DELETE FROM job_leases WHERE job_id = ? AND owner = ?', (job_id, owner))
+
+        connection.commit()
+        connection.close()
+
+
+class RedisStorage(Storage):
+    """Хранилище в Redis. Позволяет запускать реплики на разных машинах."""
+
+    # Проверка владельца и изменение ключа должны быть атомарными, поэтому через Lua
+    _RENEW_SCRIPT = '''
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("PEXPIRE", KEYS[1], ARGV[2])
+    end
+    return 0
+    '''
+    _RELEASE_SCRIPT = '''
+    if redis.call("GET", KEYS[1]) == ARGV[1] then
+        return redis.call("DEL", KEYS[1])
+    end
+    return 0
+    '''
+
+    def __init__(self, url=None, prefix='tgbot:', client=None):
+        if client is None:
+            # redis нужен только для этого бэкенда
+            import redis
+
+            client = redis.Redis.from_url(url, decode_responses=True)
+        self.client = client
+        self.prefix = prefix
+        self._renew = self.client.register_script(self._RENEW_SCRIPT)
+        self._release = self.client.register_script(self._RELEASE_SCRIPT)
+
+    def _key(self, namespace, key):
+        return f"{self.prefix}{namespace}:{key}"
+
+    def _job_key(self, job_id):
+        return f"{self.prefix}job:{job_id}"
+
+    @staticmethod
+    def _ttl_ms(ttl):
+        # redis принимает срок жизни только целым числом, поэтому переводим в миллисекунды
+        return int(ttl * 1000) if ttl else None
+
+    def get(self, namespace, key):
+        value = self.client.get(self._key(namespace, key))
+        return json.loads(value) if value is not None else None
+
+    def set(self, namespace, key, value, ttl=None):
+        self.client.set(self._key(namespace, key), json.dumps(value, ensure_ascii=False), px=self._ttl_ms(ttl))
+
+    def delete(self, namespace, key):
+        self.client.delete(self._key(namespace, key))
+
+    def add(self, namespace, key, value, ttl=None):
+        return bool(self.client.set(
+            self._key(namespace, key), json.dumps(value, ensure_ascii=False), px=self._ttl_ms(ttl), nx=True
+        ))
+
+    def keys(self, namespace):
+        prefix = self._key(namespace, '')
+        return [key[len(prefix):] for key in self.client.scan_iter(match=f"{prefix}*")]
+
+    def claim_job(self, job_id, owner, lease_seconds):
+        return bool(self.client.set(self._job_key(job_id), owner, px=self._ttl_ms(lease_seconds), nx=True))
+
+    def renew_job(self, job_id, owner, lease_seconds):
+        return bool(self._renew(keys=[self._job_key(job_id)], args=[owner, self._ttl_ms(lease_seconds)]))
+
+    def release_job(self, job_id, owner):
+        self._release(keys=[self._job_key(job_id)], args=[owner])
+
+    def close(self):
+        self.client.close()
+
+
+def create_storage(url=None):
+    """Создаёт хранилище по адресу: redis://... или rediss://... для Redis, иначе SQLite (DB_PATH)."""
+    if not url:
+        return SqliteStorage(DB_PATH)
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisStorage(url)
+    if url.startswith('sqlite:///'):
+        return SqliteStorage(url[len('sqlite:///'):])
+    raise ValueError(f"Неизвестный адрес хранилища: {url}")
+
+
+def check_shared_database(storage, db_path=DB_PATH):
+    """Проверяет, что все реплики работают с одним файлом базы пользователей и заказов.
+
+    Таблицы users и orders всегда лежат в SQLite по пути db_path, поэтому при
+    нескольких репликах этот файл должен быть общим. Файлу присваивается
+    случайный идентификатор, и первая реплика записывает его в общее хранилище;
+    реплика с другим файлом получит RuntimeError при запуске.
+    """
+    connection = sqlite3.connect(db_path, timeout=DB_TIMEOUT)
+    cursor = connection.cursor()
+
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS db_meta (
+        key TEXT PRIMARY KEY,                 -- Название параметра
+        value TEXT                            -- Значение
+    );
+    ''')
+    cursor.execute("INSERT OR IGNORE INTO db_meta (key, value) VALUES ('db_id', ?)", (uuid.uuid4().hex,))
+    cursor.execute("SELECT value FROM db_meta WHERE key = 'db_id'")
+    db_id = cursor.fetchone()[0]
+
+    connection.commit()
+    connection.close()
+
+    if not storage.add('meta', 'db_id', db_id):
+        shared_db_id = storage.get('meta', 'db_id')
+        if shared_db_id != db_id:
+            raise RuntimeError(
+                f"База {db_path} не совпадает с базой других реплик: DB_PATH должен указывать "
+                f"на один общий файл для всех реплик"
+            )
+    return db_id
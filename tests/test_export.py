@@ -0,0 +1,112 @@
+import csv
+import gzip
+import json
+import sqlite3
+
+import pytest
+
+from export import EXPORT_COLUMNS, export_orders, iter_orders, parse_date
+
+
+@pytest.fixture
+def db_path(tmp_path):
+    path = str(tmp_path / 'bot_database.db')
+    connection = sqlite3.connect(path)
+    connection.execute('''
+    CREATE TABLE users (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        orders_count INTEGER DEFAULT 0,
+        last_orders TEXT
+    );
+    ''')
+    connection.execute('''
+    CREATE TABLE orders (
+        order_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        order_number TEXT,
+        status TEXT,
+        comment TEXT,
+        created_at TEXT
+    );
+    ''')
+    connection.executemany('INSERT INTO users VALUES (?, ?, ?, ?)', [
+        (1, 'Иван', 3, ''),
+        (2, 'Пётр', 1, ''),
+    ])
+    connection.executemany(
+        'INSERT INTO orders (user_id, order_number, status, comment, created_at) VALUES (?, ?, ?, ?, ?)', [
+            (1, '100', '1', 'ок', '2024-05-01 09:00:00'),
+            (1, '101', '0', 'не открыли', '2024-05-02 23:59:59'),
+            (2, '102', '1', '-', '2024-05-03 00:00:00'),
+            (1, '103', '1', 'старый заказ', None),
+        ])
+    connection.commit()
+    connection.close()
+    return path
+
+
+def order_numbers(rows):
+    return [row[EXPORT_COLUMNS.index('order_number')] for row in rows]
+
+
+def test_no_filters_returns_all_orders(db_path):
+    assert order_numbers(iter_orders(db_path)) == ['100', '101', '102', '103']
+
+
+def test_date_to_includes_whole_day(db_path):
+    rows = iter_orders(db_path, date_to=parse_date('2024-05-02'))
+    assert order_numbers(rows) == ['100', '101']
+
+
+def test_date_range(db_path):
+    rows = iter_orders(db_path, date_from=parse_date('2024-05-02'), date_to=parse_date('2024-05-03'))
+    assert order_numbers(rows) == ['101', '102']
+
+
+def test_orders_without_date_excluded_by_date_filter(db_path):
+    assert '103' not in order_numbers(iter_orders(db_path, date_from=parse_date('2000-01-01')))
+    assert '103' not in order_numbers(iter_orders(db_path, date_to=parse_date('2100-01-01')))
+
+
+def test_user_filter(db_path):
+    assert order_numbers(iter_orders(db_path, user_id=2)) == ['102']
+    assert order_numbers(iter_orders(db_path, user_id=1)) == ['100', '101', '103']
+
+
+def test_batch_size_does_not_change_result(db_path):
+    assert list(iter_orders(db_path, batch_size=1)) == list(iter_orders(db_path, batch_size=1000))
+
+
+def test_export_csv(db_path, tmp_path):
+    output = str(tmp_path / 'orders.csv.gz')
+    assert export_orders(output, 'csv', db_path=db_path, user_id=2) == 1
+
+    with gzip.open(output, 'rt', encoding='utf-8', newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == list(EXPORT_COLUMNS)
+    assert rows[1] == ['3', '2', 'Пётр', '1', '102', '1', '-', '2024-05-03 00:00:00']
+
+
+def test_export_jsonl(db_path, tmp_path):
+    output = str(tmp_path / 'orders.jsonl.gz')
+    assert export_orders(output, 'jsonl', db_path=db_path, batch_size=1) == 4
+
+    with gzip.open(output, 'rt', encoding='utf-8') as f:
+        records = [json.loads(line) for line in f]
+    assert [tuple(record) for record in records] == [EXPORT_COLUMNS] * 4
+    assert records[0]['username'] == 'Иван'
+    assert records[3]['created_at'] is None
+
+
+def test_export_unknown_format(db_path, tmp_path):
+    with pytest.raises(ValueError):
+        export_orders(str(tmp_path / 'orders.xml.gz'), 'xml', db_path=db_path)
+
+
+def test_parse_date():
+    assert parse_date('-') is None
+    assert parse_date('') is None
+    assert str(parse_date('2024-05-02')) == '2024-05-02'
+    with pytest.raises(ValueError):
+        parse_date('02.05.2024')
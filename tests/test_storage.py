@@ -0,0 +1,251 @@
+import fnmatch
+import shutil
+import socket
+import sqlite3
+import subprocess
+import time
+
+import pytest
+
+from storage import RedisStorage, SqliteStorage, Storage, check_shared_database, create_storage
+
+# Короткие сроки, чтобы проверять истечение аренды без долгого ожидания
+LEASE = 0.3
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class FakeRedis:
+    """Минимальная замена клиента redis для тестов RedisStorage без сервера.
+
+    Lua-скрипты RedisStorage эмулируются по их смыслу: продление (PEXPIRE)
+    и удаление (DEL) ключа, только если в нём записан владелец ARGV[1].
+    """
+
+    def __init__(self):
+        self.data = {}
+        self.calls = []
+
+    def _alive(self, key):
+        value, expires_at = self.data.get(key, (None, None))
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self.data[key]
+            return None
+        return value
+
+    def get(self, key):
+        return self._alive(key)
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        # Настоящий redis не принимает дробные секунды
+        assert ex is None, "RedisStorage должен передавать срок жизни через px"
+        assert px is None or isinstance(px, int)
+        self.calls.append(('set', key, px, nx))
+        if nx and self._alive(key) is not None:
+            return None
+        self.data[key] = (value, time.monotonic() + px / 1000 if px else None)
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in list(self.data) if self._alive(key) is not None and fnmatch.fnmatchcase(key, match)]
+
+    def register_script(self, script):
+        def run(keys, args):
+            self.calls.append(('script', keys, args))
+            key, owner = keys[0], args[0]
+            if self._alive(key) != owner:
+                return 0
+            if 'PEXPIRE' in script:
+                self.data[key] = (owner, time.monotonic() + args[1] / 1000)
+            else:
+                del self.data[key]
+            return 1
+        return run
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope='module')
+def redis_url():
+    # Локальный redis-server как замена сетевого хранилища
+    pytest.importorskip('redis')
+    if not shutil.which('redis-server'):
+        pytest.skip("redis-server не установлен")
+
+    port = _free_port()
+    process = subprocess.Popen(
+        ['redis-server', '--port', str(port), '--save', '', '--appendonly', 'no'],
+        stdout=subprocess.DEVNULL,
+    )
+    url = f"redis://127.0.0.1:{port}/0"
+
+    import redis
+    client = redis.Redis.from_url(url)
+    for _ in range(50):
+        try:
+            client.ping()
+            break
+        except redis.ConnectionError:
+            time.sleep(0.1)
+    client.close()
+
+    yield url
+
+    process.terminate()
+    process.wait()
+
+
+@pytest.fixture(params=['sqlite', 'fake_redis', 'redis'])
+def storage(request, tmp_path):
+    if request.param == 'sqlite':
+        backend = SqliteStorage(str(tmp_path / 'storage.db'))
+    elif request.param == 'fake_redis':
+        backend = RedisStorage(client=FakeRedis())
+    else:
+        url = request.getfixturevalue('redis_url')
+        backend = RedisStorage(url, prefix=f"test:{tmp_path.name}:")
+    yield backend
+    backend.close()
+
+
+def test_set_get_delete(storage):
+    storage.set('state', 1, {'state': 'MEDIA', 'media': []})
+    assert storage.get('state', 1) == {'state': 'MEDIA', 'media': []}
+
+    storage.delete('state', 1)
+    assert storage.get('state', 1) is None
+
+
+def test_set_with_ttl_expires(storage):
+    storage.set('folders', '123', True, ttl=LEASE)
+    assert storage.get('folders', '123') is True
+
+    time.sleep(LEASE + 0.1)
+    assert storage.get('folders', '123') is None
+
+
+def test_add_deduplicates_until_expired(storage):
+    assert storage.add('updates', 42, True, ttl=LEASE)
+    assert not storage.add('updates', 42, True, ttl=LEASE)
+
+    time.sleep(LEASE + 0.1)
+    assert storage.add('updates', 42, True, ttl=LEASE)
+
+
+def test_keys(storage):
+    storage.set('reports', 'a', 1)
+    storage.set('reports', 'b', 2, ttl=LEASE)
+    storage.set('other', 'c', 3)
+    assert sorted(storage.keys('reports')) == ['a', 'b']
+
+    time.sleep(LEASE + 0.1)
+    assert storage.keys('reports') == ['a']
+
+
+def test_claim_is_exclusive(storage):
+    assert storage.claim_job('report:1', 'A', 5)
+    assert not storage.claim_job('report:1', 'B', 5)
+    assert not storage.claim_job('report:1', 'A', 5)
+
+
+def test_renew_and_release_only_by_owner(storage):
+    assert storage.claim_job('report:1', 'A', 5)
+    assert storage.renew_job('report:1', 'A', 5)
+    assert not storage.renew_job('report:1', 'B', 5)
+
+    storage.release_job('report:1', 'B')
+    assert not storage.claim_job('report:1', 'B', 5)
+
+    storage.release_job('report:1', 'A')
+    assert storage.claim_job('report:1', 'B', 5)
+
+
+def test_expired_lease_is_taken_over(storage):
+    assert storage.claim_job('report:1', 'A', LEASE)
+    time.sleep(LEASE + 0.1)
+
+    # После истечения аренды прежний владелец её не продлит, а другая реплика захватит
+    assert not storage.renew_job('report:1', 'A', 5)
+    assert storage.claim_job('report:1', 'B', 5)
+    assert not storage.renew_job('report:1', 'A', 5)
+    assert storage.renew_job('report:1', 'B', 5)
+
+
+def test_redis_keys_and_lease_commands():
+    client = FakeRedis()
+    backend = RedisStorage(client=client, prefix='bot:')
+
+    backend.set('reports', 'report:1:10', {'order_number': '5'})
+    backend.set('reportsx', 'other', 1)
+    assert backend.keys('reports') == ['report:1:10']
+    assert client.get('bot:reports:report:1:10') == '{"order_number": "5"}'
+
+    assert backend.claim_job('report:1:10', 'A', 1.5)
+    assert client.calls[-1] == ('set', 'bot:job:report:1:10', 1500, True)
+
+    assert backend.renew_job('report:1:10', 'A', 2)
+    assert client.calls[-1] == ('script', ['bot:job:report:1:10'], ['A', 2000])
+    assert not backend.renew_job('report:1:10', 'B', 2)
+
+    backend.release_job('report:1:10', 'B')
+    assert client.get('bot:job:report:1:10') == 'A'
+    backend.release_job('report:1:10', 'A')
+    assert client.get('bot:job:report:1:10') is None
+
+
+def test_sqlite_purges_expired_rows(tmp_path, monkeypatch):
+    monkeypatch.setattr('storage.PURGE_INTERVAL_SECONDS', 0)
+    backend = SqliteStorage(str(tmp_path / 'storage.db'))
+
+    for update_id in range(10):
+        backend.add('updates', update_id, True, ttl=0.01)
+        backend.claim_job(f"report:{update_id}", 'A', 0.01)
+    time.sleep(0.05)
+    backend.add('updates', 'last', True)
+    backend.claim_job('report:last', 'A', 5)
+
+    connection = sqlite3.connect(backend.db_path)
+    assert connection.execute('SELECT COUNT(*) FROM kv_store').fetchone()[0] == 1
+    assert connection.execute('SELECT COUNT(*) FROM job_leases').fetchone()[0] == 1
+    connection.close()
+
+
+def test_check_shared_database(tmp_path):
+    shared = RedisStorage(client=FakeRedis())
+    db_path = str(tmp_path / 'bot_database.db')
+
+    # Реплики с одним файлом проходят проверку, идентификатор файла не меняется
+    db_id = check_shared_database(shared, db_path)
+    assert check_shared_database(shared, db_path) == db_id
+
+    # Реплика со своим файлом не должна запуститься
+    with pytest.raises(RuntimeError):
+        check_shared_database(shared, str(tmp_path / 'other.db'))
+
+
+def test_check_shared_database_with_sqlite_storage(tmp_path):
+    db_path = str(tmp_path / 'bot_database.db')
+    assert check_shared_database(SqliteStorage(db_path), db_path)
+
+
+def test_incomplete_backend_fails_on_creation():
+    class Incomplete(Storage):
+        def get(self, namespace, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_create_storage(tmp_path):
+    assert isinstance(create_storage(f"sqlite:///{tmp_path / 'storage.db'}"), SqliteStorage)
+    with pytest.raises(ValueError):
+        create_storage('memcached://localhost')